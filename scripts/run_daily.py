@@ -1,54 +1,67 @@
 ﻿from __future__ import annotations
+import time
+
+_T0 = time.perf_counter()
+
 import argparse
+import hashlib
+import json
+import sys
 from datetime import datetime, timezone
-import pandas as pd
-from src.prices import fetch_ohlcv_batch_retry, upsert_parquet
-import time
 
+# ここでは軽い config だけ読む。pandas / yfinance / src の各モジュールは
+# サブコマンドの中で必要な分だけ import する（screen を何度も回すとき用）
 from src.config import (
     ensure_dirs, PRICES_DIR, OUTPUTS_DIR, DOCS_DIR,
-    UNIV_US, UNIV_JP, EXCLUDE, TOO_SHORT,
+    UNIV_US, UNIV_JP, EXCLUDE, TOO_SHORT, SCREEN_CACHE, STRATEGIES_DIR,
     US_INDEX_TICKER, JP_INDEX_TICKER,
     MIN_ROWS, BATCH_SIZE, MAX_ROWS_KEEP,
 )
-from src.universe import build_universe_us_sp500, build_universe_jp_topix_newindex
-from src.prices import bulk_update
-from src.audit import is_healthy_parquet, delete_empty_parquets, update_exclude_and_shortlists
-from src.screen import ScreenParams, market_filter_ok, run_screen
-from src.dashboard import build_dashboard
+
+META_LATEST = OUTPUTS_DIR / "meta_latest.json"
+SCREEN_LATEST = OUTPUTS_DIR / "screen_latest.csv"
+AUDIT_LATEST = OUTPUTS_DIR / "audit_latest.csv"
+SCREEN_DIAGNOSTICS = OUTPUTS_DIR / "screen_diagnostics.csv"
+
+# ネットワーク不要なサブコマンドの起動予算（import完了まで, 秒）
+STARTUP_BUDGET_S = 1.5
+# サブコマンドが import するモジュール（予算の計測前に読み込んでおく）
+OFFLINE_COMMANDS = {
+    "audit": ("pandas", "src.audit", "src.store"),
+    "screen": ("pandas", "src.screen", "src.screen_cache", "src.store"),
+    "publish": ("pandas", "src.dashboard", "src.store"),
+}
+NETWORK_MODULES = ("yfinance", "requests")
 
 def load_or_build_universe():
-    if not UNIV_US.exists():
-        build_universe_us_sp500(UNIV_US)
-    if not UNIV_JP.exists():
-        build_universe_jp_topix_newindex(UNIV_JP)
+    import pandas as pd
+    if not UNIV_US.exists() or not UNIV_JP.exists():
+        from src.universe import build_universe_us_sp500, build_universe_jp_topix_newindex
+        if not UNIV_US.exists():
+            build_universe_us_sp500(UNIV_US)
+        if not UNIV_JP.exists():
+            build_universe_jp_topix_newindex(UNIV_JP)
     us = pd.read_csv(UNIV_US)
     jp = pd.read_csv(UNIV_JP)
     return us, jp
 
 def apply_exclude(tickers: list[str]) -> list[str]:
+    import pandas as pd
     if EXCLUDE.exists():
         ex = pd.read_csv(EXCLUDE)
         exclude_set = set(ex["ticker"].astype(str))
         tickers = [t for t in tickers if t not in exclude_set]
     return tickers
 
-def apply_tooshort(univ: pd.DataFrame) -> pd.DataFrame:
+def apply_tooshort(univ):
+    import pandas as pd
     if TOO_SHORT.exists():
         ts = pd.read_csv(TOO_SHORT)
         bad = set(ts["ticker"].astype(str))
         univ = univ[~univ["ticker"].astype(str).isin(bad)].copy()
     return univ
 
-def main():
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--initial", action="store_true", help="force initial(600d) build")
-    ap.add_argument("--period-initial", default="600d")
-    ap.add_argument("--period-daily", default="30d")
-    args = ap.parse_args()
-
-    ensure_dirs()
-
+def load_universe_and_tickers():
     us, jp = load_or_build_universe()
     us = apply_tooshort(us)
     jp = apply_tooshort(jp)
@@ -57,66 +70,289 @@ def main():
                 + jp[jp["enabled"] == True]["ticker"].astype(str).tolist() \
                 + [US_INDEX_TICKER, JP_INDEX_TICKER]
     tickers_all = apply_exclude(tickers_all)
+    return us, jp, tickers_all
+
+def load_meta() -> dict:
+    if not META_LATEST.exists():
+        return {}
+    try:
+        return json.loads(META_LATEST.read_text(encoding="utf-8"))
+    except ValueError:
+        return {}
+
+def update_meta(stage: str | None = None, **kv) -> dict:
+    # サブコマンドを別プロセスで回しても publish が全体の meta を出せるよう、段ごとに追記する。
+    # 段ごとに <stage>_ts_utc を残し、どの値がいつのものか分かるようにする
+    from src.store import atomic_write_text
+    meta = load_meta()
+    if stage is not None:
+        meta[f"{stage}_ts_utc"] = datetime.now(timezone.utc).isoformat()
+    meta.update(kv)
+    atomic_write_text(META_LATEST, json.dumps(meta, ensure_ascii=False, indent=2))
+    return meta
+
+def check_startup(cmd: str) -> float:
+    # 単独で起動したオフラインのサブコマンドだけ測る（all の途中の段は対象外）
+    import importlib
+    for m in OFFLINE_COMMANDS[cmd]:
+        importlib.import_module(m)
+    startup_s = time.perf_counter() - _T0
+    loaded = [m for m in NETWORK_MODULES if m in sys.modules]
+    if loaded:
+        print(f"warn: offline command '{cmd}' imported {loaded}")
+    if startup_s > STARTUP_BUDGET_S:
+        print(f"warn: startup {startup_s:.2f}s > budget {STARTUP_BUDGET_S:.2f}s")
+    return startup_s
+
+def cmd_fetch(args) -> dict:
+    from src.prices import bulk_update
+    from src.store import PriceManifest, cleanup_tmp_files
+
+    _, _, tickers_all = load_universe_and_tickers()
+
+    # 前回落ちた書きかけの残骸を掃除してから manifest を読む
+    cleanup_tmp_files(PRICES_DIR)
+    manifest = PriceManifest.load(PRICES_DIR)
 
     parquet_count = len(list(PRICES_DIR.glob("*.parquet")))
     do_initial = args.initial or (parquet_count < 50)
     period = args.period_initial if do_initial else args.period_daily
 
-    saved, missing_fetch = bulk_update(
-        tickers_all,
-        PRICES_DIR,
+    # 日次でも、まだファイルが無い銘柄だけは初期期間で取る（30dだとtoo_shortで除外されてしまう）
+    if do_initial:
+        tickers_new, tickers_daily = tickers_all, []
+    else:
+        tickers_new = [t for t in tickers_all if t not in manifest and not (PRICES_DIR / f"{t}.parquet").exists()]
+        new_set = set(tickers_new)
+        tickers_daily = [t for t in tickers_all if t not in new_set]
+
+    saved, missing_fetch = [], []
+    for tickers, per in [(tickers_new, args.period_initial), (tickers_daily, args.period_daily)]:
+        if not tickers:
+            continue
+        s, m = bulk_update(
+            tickers,
+            PRICES_DIR,
+            period=per,
+            batch_size=BATCH_SIZE,
+            max_rows=MAX_ROWS_KEEP,
+            manifest=manifest,
+        )
+        saved += s
+        missing_fetch += m
+
+    return update_meta(
+        "fetch",
+        mode="initial" if do_initial else "daily",
         period=period,
-        batch_size=BATCH_SIZE,
-        max_rows=MAX_ROWS_KEEP,
+        saved=len(saved),
+        missing_fetch=len(missing_fetch),
     )
 
-    healthy = [t for t in tickers_all if is_healthy_parquet(PRICES_DIR, t, min_rows=MIN_ROWS)]
-    missing_real = [t for t in tickers_all if t not in healthy]
+def cmd_audit(args) -> dict:
+    from src.audit import is_healthy_parquet, delete_empty_parquets, update_exclude_and_shortlists
+    from src.store import PriceManifest, atomic_write_csv
 
-    deleted = delete_empty_parquets(PRICES_DIR, tickers_all)
+    _, _, tickers_all = load_universe_and_tickers()
+    manifest = PriceManifest.load(PRICES_DIR)
+
+    healthy = [t for t in tickers_all if is_healthy_parquet(PRICES_DIR, t, min_rows=MIN_ROWS, manifest=manifest)]
+    healthy_set = set(healthy)
+    missing_real = [t for t in tickers_all if t not in healthy_set]
+
+    deleted = delete_empty_parquets(PRICES_DIR, tickers_all, manifest=manifest)
     miss_df = update_exclude_and_shortlists(
         PRICES_DIR, missing_real,
         exclude_path=EXCLUDE,
         tooshort_path=TOO_SHORT,
-        min_rows=MIN_ROWS
+        min_rows=MIN_ROWS,
+        manifest=manifest,
     )
+    manifest.save()
+    atomic_write_csv(AUDIT_LATEST, miss_df)
+
+    return update_meta(
+        "audit",
+        healthy=len(healthy),
+        missing_real=len(missing_real),
+        deleted_empty=len(deleted),
+        manifest_tickers=len(manifest),
+    )
+
+def cmd_screen(args) -> dict:
+    from src.screen import ScreenParams, market_filter_ok, run_screen, run_screen_streaming
+    from src.screen_cache import ScreenCache
+    from src.store import atomic_write_csv
+
+    us, jp = load_or_build_universe()
+    us = apply_tooshort(us)
+    jp = apply_tooshort(jp)
 
     us_ok = market_filter_ok(PRICES_DIR, US_INDEX_TICKER, ma_days=50)
     jp_ok = market_filter_ok(PRICES_DIR, JP_INDEX_TICKER, ma_days=50)
 
+    if args.rules:
+        return screen_rules(args, us, jp, us_ok, jp_ok)
+
     params = ScreenParams()
-    screen_df = run_screen(us, jp, params)
-
-    out_csv = OUTPUTS_DIR / "screen_latest.csv"
-    out_audit = OUTPUTS_DIR / "audit_latest.csv"
-    meta = {
-        "ts_utc": datetime.now(timezone.utc).isoformat(),
-        "mode": "initial" if do_initial else "daily",
-        "period": period,
-        "saved": len(saved),
-        "missing_fetch": len(missing_fetch),
-        "healthy": len(healthy),
-        "missing_real": len(missing_real),
-        "deleted_empty": len(deleted),
-        "us_index_ok": bool(us_ok),
-        "jp_index_ok": bool(jp_ok),
-    }
-
-    screen_df.to_csv(out_csv, index=False, encoding="utf-8")
-    miss_df.to_csv(out_audit, index=False, encoding="utf-8")
+    # キャッシュは全銘柄の行をメモリに持つので、メモリ一定の --stream では使わない
+    cache = None if (args.no_cache or args.stream) else ScreenCache.load(SCREEN_CACHE, PRICES_DIR)
+    if args.stream:
+        # 大きいユニバース向け：候補は上位 top-k だけ持ち、全銘柄の診断は逐次ファイルへ
+        screen_df = run_screen_streaming(
+            us, jp, params,
+            diag_path=SCREEN_DIAGNOSTICS,
+            top_k=args.top_k,
+            chunk_size=args.chunk_size,
+            cache=cache,
+        )
+    else:
+        screen_df = run_screen(us, jp, params, cache=cache)
+
+    # 結果が前回と同じなら書き換えない（publish 側もこれを見てスキップする）
+    text = screen_df.to_csv(index=False)
+    if not SCREEN_LATEST.exists() or SCREEN_LATEST.read_text(encoding="utf-8") != text:
+        atomic_write_csv(SCREEN_LATEST, screen_df)
+
+    if cache is not None:
+        print(f"cache: hit={cache.hits} miss={cache.misses}")
+    print("candidates:", 0 if screen_df.empty else len(screen_df))
+    return update_meta(
+        "screen",
+        us_index_ok=bool(us_ok),
+        jp_index_ok=bool(jp_ok),
+    )
+
+def screen_rules(args, us, jp, us_ok, jp_ok) -> dict:
+    # DSL の戦略はまとめて1回のデータ走査で評価し、戦略ごとに CSV を出す
+    from pathlib import Path
+    from src.rules import load_strategy, run_strategies
+    from src.store import atomic_write_csv
+
+    strategies = []
+    for r in args.rules:
+        path = Path(r)
+        if not path.exists() and (STRATEGIES_DIR / path).exists():
+            path = STRATEGIES_DIR / path
+        strategies.append(load_strategy(path))
+
+    results = run_strategies(us, jp, strategies, prices_dir=PRICES_DIR, us_ok=us_ok, jp_ok=jp_ok)
+    for name, df in results.items():
+        atomic_write_csv(OUTPUTS_DIR / f"screen_{name}.csv", df)
+        print(f"candidates[{name}]:", len(df))
+    return update_meta(
+        "screen",
+        us_index_ok=bool(us_ok),
+        jp_index_ok=bool(jp_ok),
+    )
+
+def cmd_publish(args) -> dict:
+    import pandas as pd
+    from src.dashboard import build_dashboard
+    from src.store import atomic_write_csv
+
+    try:
+        screen_df = pd.read_csv(SCREEN_LATEST)
+    except (FileNotFoundError, pd.errors.EmptyDataError):
+        screen_df = pd.DataFrame()
+
+    # "_" 始まりは内部用（ダッシュボードには出さない）
+    stored = load_meta()
+    meta = {"ts_utc": datetime.now(timezone.utc).isoformat()}
+    meta.update({k: v for k, v in stored.items() if k != "ts_utc" and not k.startswith("_")})
 
     docs_csv = DOCS_DIR / "screen_latest.csv"
     docs_html = DOCS_DIR / "index.html"
-    screen_df.to_csv(docs_csv, index=False, encoding="utf-8")
+
+    # 候補も meta も前回 publish から変わっていなければ作り直さない（時刻は比較しない）
+    fp_meta = {k: v for k, v in meta.items() if k != "ts_utc" and not k.endswith("_ts_utc")}
+    fp_src = screen_df.to_csv(index=False) + json.dumps(fp_meta, sort_keys=True)
+    fp = hashlib.sha256(fp_src.encode("utf-8")).hexdigest()
+    if not args.force and stored.get("_published") == fp and docs_html.exists() and docs_csv.exists():
+        print("publish: unchanged, skipped")
+        return meta
+
+    atomic_write_csv(docs_csv, screen_df)
     build_dashboard(docs_html, screen_df, meta, csv_rel_path="screen_latest.csv")
+    update_meta(_published=fp)
 
     print("meta:", meta)
-    print("candidates:", 0 if screen_df.empty else len(screen_df))
+    return meta
+
+def cmd_all(args) -> dict:
+    cmd_fetch(args)
+    cmd_audit(args)
+    cmd_screen(args)
+    return cmd_publish(args)
+
+COMMANDS = {
+    "fetch": cmd_fetch,
+    "audit": cmd_audit,
+    "screen": cmd_screen,
+    "publish": cmd_publish,
+    "all": cmd_all,
+}
+
+def positive_int(s: str) -> int:
+    v = int(s)
+    if v < 1:
+        raise argparse.ArgumentTypeError(f"must be >= 1: {s}")
+    return v
+
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="cmd")
+
+    def add_fetch_args(p: argparse.ArgumentParser) -> None:
+        p.add_argument("--initial", action="store_true", help="force initial(600d) build")
+        p.add_argument("--period-initial", default="600d")
+        p.add_argument("--period-daily", default="30d")
+
+    def add_screen_args(p: argparse.ArgumentParser) -> None:
+        p.add_argument("--no-cache", action="store_true", help="recompute every ticker")
+        p.add_argument("--stream", action="store_true",
+                       help="bounded memory: keep only the top-k candidates, write all rows to screen_diagnostics.csv (no cache)")
+        p.add_argument("--top-k", type=positive_int, default=200)
+        p.add_argument("--chunk-size", type=positive_int, default=500)
+
+    def add_publish_args(p: argparse.ArgumentParser) -> None:
+        p.add_argument("--force", action="store_true", help="rebuild docs even if unchanged")
+
+    add_fetch_args(sub.add_parser("fetch", help="download prices (network)"))
+    sub.add_parser("audit", help="check price files, update exclude/too_short lists")
+    p_screen = sub.add_parser("screen", help="run the screen on existing prices")
+    add_screen_args(p_screen)
+    # --rules は screen_<name>.csv だけを書く（screen_latest は更新しない）ので all では受け付けない
+    p_screen.add_argument("--rules", action="append", default=[], metavar="TOML",
+                          help="screen with rule files instead of ScreenParams (repeatable, one pass)")
+    add_publish_args(sub.add_parser("publish", help="rebuild docs/ from the latest screen output"))
+    p_all = sub.add_parser("all", help="fetch → audit → screen → publish")
+    add_fetch_args(p_all)
+    add_screen_args(p_all)
+    add_publish_args(p_all)
+    p_all.set_defaults(rules=[])
+    return ap
+
+def main(argv: list[str] | None = None):
+    argv = sys.argv[1:] if argv is None else list(argv)
+    # 従来どおり引数なし / --initial だけでも全工程を回す
+    if not argv or (argv[0].startswith("-") and argv[0] not in ("-h", "--help")):
+        argv = ["all"] + argv
+    ap = build_parser()
+    args = ap.parse_args(argv)
+    if args.cmd == "screen" and args.rules and (args.stream or args.no_cache):
+        ap.error("--rules cannot be combined with --stream / --no-cache")
+
+    ensure_dirs()
+    if args.cmd in OFFLINE_COMMANDS:
+        check_startup(args.cmd)
+    COMMANDS[args.cmd](args)
 
 if __name__ == "__main__":
     main()
 
 def daily_update_parquets_safe(tickers, prices_dir, period="30d", batch_size=20, max_rows=1200, sleep_between_batches=2.0):
+    from src.prices import fetch_ohlcv_batch_retry, upsert_parquet
     saved, missing = [], []
 
     # 1) 指数を先に（地合いが死ぬと全スクリーニングが腐る）
@@ -1,35 +1,55 @@
 ﻿from __future__ import annotations
 from pathlib import Path
 import pandas as pd
+from .store import PriceManifest, atomic_write_csv
 
 FIELDS = {"Open", "High", "Low", "Close", "Volume"}
 
-def is_healthy_parquet(prices_dir: Path, ticker: str, min_rows: int) -> bool:
+def _file_stats(prices_dir: Path, ticker: str, manifest: PriceManifest | None) -> dict | None:
+    # manifestが新しければデータファイルは開かない。無い/古いときだけ読み直す
     p = prices_dir / f"{ticker}.parquet"
+    if manifest is not None:
+        e = manifest.get(ticker)
+        if e is not None:
+            return e
+        return manifest.refresh(ticker)
     if not p.exists():
-        return False
+        return None
     df = pd.read_parquet(p)
-    if df is None or df.empty:
+    if df is None:
+        df = pd.DataFrame()
+    return {
+        "rows": len(df),
+        "rows_valid": len(df.dropna()),
+        "columns": [str(c) for c in df.columns],
+    }
+
+def is_healthy_parquet(prices_dir: Path, ticker: str, min_rows: int, manifest: PriceManifest | None = None) -> bool:
+    try:
+        st = _file_stats(prices_dir, ticker, manifest)
+    except Exception:
+        # 読めない＝壊れている。削除は delete_empty_parquets に任せる
+        return False
+    if st is None or st["rows"] == 0:
         return False
-    if not FIELDS.issubset(set(df.columns)):
+    if not FIELDS.issubset(set(st["columns"])):
         return False
-    if len(df.dropna()) < min_rows:
+    if st["rows_valid"] < min_rows:
         return False
     return True
 
-def classify_missing(prices_dir: Path, tickers: list[str], min_rows: int) -> pd.DataFrame:
+def classify_missing(prices_dir: Path, tickers: list[str], min_rows: int, manifest: PriceManifest | None = None) -> pd.DataFrame:
     # 空でも列を持たせる（ここが今回の落ち所）
     rows = []
     for t in tickers:
-        p = prices_dir / f"{t}.parquet"
-        if not p.exists():
+        st = _file_stats(prices_dir, t, manifest)
+        if st is None:
             rows.append({"ticker": t, "reason": "missing_file"})
             continue
-        df = pd.read_parquet(p)
-        if df is None or df.empty:
+        if st["rows"] == 0:
             rows.append({"ticker": t, "reason": "empty"})
             continue
-        if len(df.dropna()) < min_rows:
+        if st["rows_valid"] < min_rows:
             rows.append({"ticker": t, "reason": f"too_short<{min_rows}"})
             continue
         rows.append({"ticker": t, "reason": "ok"})
@@ -41,8 +61,9 @@ def update_exclude_and_shortlists(
     exclude_path: Path,
     tooshort_path: Path,
     min_rows: int,
+    manifest: PriceManifest | None = None,
 ) -> pd.DataFrame:
-    miss_df = classify_missing(prices_dir, missing_real, min_rows=min_rows)
+    miss_df = classify_missing(prices_dir, missing_real, min_rows=min_rows, manifest=manifest)
 
     # 欠損がゼロなら何もすることがない（でも空の監査表は返す）
     if miss_df.empty:
@@ -56,20 +77,27 @@ def update_exclude_and_shortlists(
             ex = pd.concat([ex, to_ex], ignore_index=True).drop_duplicates(subset=["ticker"], keep="last")
         else:
             ex = to_ex
-        ex.to_csv(exclude_path, index=False, encoding="utf-8")
+        atomic_write_csv(exclude_path, ex)
 
     to_short = miss_df[miss_df["reason"].str.startswith("too_short")].copy()
     if not to_short.empty:
-        to_short.to_csv(tooshort_path, index=False, encoding="utf-8")
+        atomic_write_csv(tooshort_path, to_short)
 
     return miss_df
 
-def delete_empty_parquets(prices_dir: Path, tickers: list[str]) -> list[str]:
+def delete_empty_parquets(prices_dir: Path, tickers: list[str], manifest: PriceManifest | None = None) -> list[str]:
+    # 書き込みはアトミックなので、読めないファイルは本当に壊れている（書きかけではない）
     deleted = []
     for t in tickers:
         p = prices_dir / f"{t}.parquet"
         if not p.exists():
+            if manifest is not None:
+                manifest.drop(t)
             continue
+        if manifest is not None:
+            e = manifest.get(t)
+            if e is not None and e["rows"] > 0:
+                continue
         try:
             df = pd.read_parquet(p)
             if df is None or df.empty:
@@ -78,4 +106,7 @@ def delete_empty_parquets(prices_dir: Path, tickers: list[str]) -> list[str]:
         except Exception:
             p.unlink()
             deleted.append(t)
+    if manifest is not None:
+        for t in deleted:
+            manifest.drop(t)
     return deleted
@@ -8,12 +8,15 @@ BASE_DIR = Path(__file__).resolve().parents[1]
 DATA_DIR = BASE_DIR / "data"
 PRICES_DIR = DATA_DIR / "prices"
 OUTPUTS_DIR = DATA_DIR / "outputs"
+CACHE_DIR = DATA_DIR / "cache"
 DOCS_DIR = BASE_DIR / "docs"
+STRATEGIES_DIR = BASE_DIR / "strategies"
 
 UNIV_US = DATA_DIR / "universe_us.csv"
 UNIV_JP = DATA_DIR / "universe_jp.csv"
 EXCLUDE = DATA_DIR / "universe_exclude.csv"
 TOO_SHORT = DATA_DIR / "universe_too_short.csv"
+SCREEN_CACHE = CACHE_DIR / "screen_cache.json"
 
 MIN_ROWS = 260
 BATCH_SIZE = 20
@@ -23,4 +26,5 @@ def ensure_dirs() -> None:
     DATA_DIR.mkdir(parents=True, exist_ok=True)
     PRICES_DIR.mkdir(parents=True, exist_ok=True)
     OUTPUTS_DIR.mkdir(parents=True, exist_ok=True)
+    CACHE_DIR.mkdir(parents=True, exist_ok=True)
     DOCS_DIR.mkdir(parents=True, exist_ok=True)
@@ -2,6 +2,7 @@
 from pathlib import Path
 import pandas as pd
 import json
+from .store import atomic_write_text
 
 def build_dashboard(out_html: Path, screen_df: pd.DataFrame, meta: dict, csv_rel_path: str = "screen_latest.csv") -> None:
     out_html.parent.mkdir(parents=True, exist_ok=True)
@@ -32,4 +33,4 @@ th {{ background: #f6f6f6; text-align: left; }}
 </body>
 </html>
 """
-    out_html.write_text(html, encoding="utf-8")
+    atomic_write_text(out_html, html)
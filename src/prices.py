@@ -1,10 +1,10 @@
 ﻿from __future__ import annotations
 from pathlib import Path
 import pandas as pd
-import yfinance as yf
 import time
 import random
 from typing import Dict
+from .store import PriceManifest, atomic_write_parquet
 
 FIELDS = ["Open", "High", "Low", "Close", "Volume"]
 
@@ -15,6 +15,9 @@ def fetch_ohlcv_batch(tickers, period="60d", interval="1d") -> dict[str, pd.Data
     if not tickers:
         return {}
 
+    # yfinanceは重いので、実際に取りに行くときだけ読む
+    import yfinance as yf
+
     df = yf.download(
         tickers=" ".join(tickers),
         period=period,
@@ -70,7 +73,7 @@ def fetch_ohlcv_batch(tickers, period="60d", interval="1d") -> dict[str, pd.Data
 
     return out
 
-def upsert_parquet(ticker: str, new_df: pd.DataFrame, prices_dir: Path, max_rows=1200) -> bool:
+def upsert_parquet(ticker: str, new_df: pd.DataFrame, prices_dir: Path, max_rows=1200, manifest: PriceManifest | None = None) -> bool:
     prices_dir.mkdir(parents=True, exist_ok=True)
     path = prices_dir / f"{ticker}.parquet"
 
@@ -91,10 +94,15 @@ def upsert_parquet(ticker: str, new_df: pd.DataFrame, prices_dir: Path, max_rows
         merged = merged.iloc[-max_rows:]
 
     merged.columns.name = None
-    merged.to_parquet(path)
+    # 書きかけで落ちても既存ファイルを壊さない（write-then-rename）
+    checksum = atomic_write_parquet(path, merged)
+    if manifest is not None:
+        manifest.record(ticker, merged, checksum)
     return True
 
-def bulk_update(tickers: list[str], prices_dir: Path, period: str, batch_size=80, max_rows=1200):
+def bulk_update(tickers: list[str], prices_dir: Path, period: str, batch_size=80, max_rows=1200, manifest: PriceManifest | None = None):
+    if manifest is None:
+        manifest = PriceManifest.load(prices_dir)
     saved, missing = [], []
     for i in range(0, len(tickers), batch_size):
         batch = tickers[i:i+batch_size]
@@ -103,8 +111,10 @@ def bulk_update(tickers: list[str], prices_dir: Path, period: str, batch_size=80
             if t not in got:
                 missing.append(t)
                 continue
-            upsert_parquet(t, got[t], prices_dir, max_rows=max_rows)
+            upsert_parquet(t, got[t], prices_dir, max_rows=max_rows, manifest=manifest)
             saved.append(t)
+        # バッチ単位でmanifestを確定させる
+        manifest.save()
     return saved, missing
 
 def fetch_ohlcv_batch_retry(
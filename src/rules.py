@@ -0,0 +1,409 @@
+﻿from __future__ import annotations
+
+import ast
+import math
+import tomllib
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict
+import numpy as np
+import pandas as pd
+
+from .config import PRICES_DIR, US_INDEX_TICKER, JP_INDEX_TICKER
+
+# 式の中で使える列名 → parquet の列
+FIELDS = {"open": "Open", "high": "High", "low": "Low", "close": "Close", "volume": "Volume"}
+
+# 関数名 → (系列引数の数, 整数引数の数)
+FUNCS = {
+    "rolling_mean": (1, 1),
+    "rolling_max": (1, 1),
+    "rolling_min": (1, 1),
+    "rolling_sum": (1, 1),
+    "shift": (1, 1),
+    "abs": (1, 0),
+    "where": (3, 0),
+    "max": (-1, 0),  # 可変長
+    "min": (-1, 0),
+}
+
+BINOPS = {ast.Add: "add", ast.Sub: "sub", ast.Mult: "mul", ast.Div: "div"}
+CMPOPS = {ast.Lt: "lt", ast.LtE: "le", ast.Gt: "gt", ast.GtE: "ge", ast.Eq: "eq", ast.NotEq: "ne"}
+
+
+@dataclass
+class Strategy:
+    """
+    TOMLで書いたスクリーニング定義。
+    indicators は上から順に評価され、後の式から名前で参照できる。
+    scores の各項は <name>_score 列になり、その合計が score_total。
+    """
+    name: str
+    params: Dict[str, float] = field(default_factory=dict)
+    indicators: Dict[str, str] = field(default_factory=dict)
+    scores: Dict[str, str] = field(default_factory=dict)
+    passed: str = "True"
+    sort: list[str] = field(default_factory=lambda: ["score_total"])
+    min_rows: int = 220
+
+
+def load_strategy(path: Path) -> Strategy:
+    with open(path, "rb") as f:
+        raw = tomllib.load(f)
+    return Strategy(
+        name=str(raw.get("name", path.stem)),
+        params=dict(raw.get("params", {})),
+        indicators={k: str(v) for k, v in raw.get("indicators", {}).items()},
+        scores={k: str(v) for k, v in raw.get("scores", {}).items()},
+        passed=str(raw.get("passed", "True")),
+        sort=list(raw.get("sort", ["score_total"])),
+        min_rows=int(raw.get("min_rows", 220)),
+    )
+
+
+# --- 式 → ノード（ネストしたtuple） ---
+# ノードは構造そのものがキーなので、同じ式は戦略をまたいでも1回しか計算しない
+
+def _parse(expr: str, names: dict[str, tuple], params: dict[str, float]) -> tuple:
+    try:
+        tree = ast.parse(expr.strip(), mode="eval")
+    except SyntaxError as e:
+        raise RuntimeError(f"ルール式を解釈できません: {expr!r} ({e.msg})")
+
+    def int_arg(n: ast.AST) -> int:
+        v = conv(n)
+        if v[0] != "const" or float(v[1]) != int(v[1]):
+            raise RuntimeError(f"整数の定数が必要です: {ast.unparse(n)} in {expr!r}")
+        return int(v[1])
+
+    def call(fname: str, args: list[ast.AST]) -> tuple:
+        if fname not in FUNCS:
+            raise RuntimeError(f"未知の関数: {fname} in {expr!r}")
+        n_series, n_int = FUNCS[fname]
+        if n_series == -1:
+            if len(args) < 1:
+                raise RuntimeError(f"{fname} に引数がありません: {expr!r}")
+            return (fname,) + tuple(conv(a) for a in args)
+        if len(args) != n_series + n_int:
+            raise RuntimeError(f"{fname} の引数の数が違います: {expr!r}")
+        series = tuple(conv(a) for a in args[:n_series])
+        if (fname == "shift" or fname.startswith("rolling_")) and series[0][0] in ("const", "bool"):
+            raise RuntimeError(f"{fname} の第1引数は系列が必要です: {ast.unparse(args[0])} in {expr!r}")
+        ints = tuple(int_arg(a) for a in args[n_series:])
+        return (fname,) + series + ints
+
+    def conv(n: ast.AST) -> tuple:
+        # True == 1 なので bool は別の種類にしておく（ノードの同一視を防ぐ）
+        if isinstance(n, ast.Constant) and isinstance(n.value, bool):
+            return ("bool", n.value)
+        if isinstance(n, ast.Constant) and isinstance(n.value, (int, float)):
+            return ("const", n.value)
+        if isinstance(n, ast.Name):
+            if n.id in names:
+                return names[n.id]
+            if n.id in params:
+                v = params[n.id]
+                return ("bool", v) if isinstance(v, bool) else ("const", v)
+            if n.id in FIELDS:
+                return ("field", FIELDS[n.id])
+            raise RuntimeError(f"未定義の名前: {n.id} in {expr!r}")
+        if isinstance(n, ast.BinOp) and type(n.op) in BINOPS:
+            return (BINOPS[type(n.op)], conv(n.left), conv(n.right))
+        if isinstance(n, ast.UnaryOp) and isinstance(n.op, ast.USub):
+            return ("sub", ("const", 0), conv(n.operand))
+        if isinstance(n, ast.UnaryOp) and isinstance(n.op, ast.Not):
+            return ("not", conv(n.operand))
+        if isinstance(n, ast.BoolOp):
+            op = "and" if isinstance(n.op, ast.And) else "or"
+            out = conv(n.values[0])
+            for v in n.values[1:]:
+                out = (op, out, conv(v))
+            return out
+        if isinstance(n, ast.Compare):
+            # a < b < c は (a < b) and (b < c)
+            out = None
+            left = conv(n.left)
+            for op, comp in zip(n.ops, n.comparators):
+                if type(op) not in CMPOPS:
+                    raise RuntimeError(f"使えない比較演算子: {expr!r}")
+                right = conv(comp)
+                term = (CMPOPS[type(op)], left, right)
+                out = term if out is None else ("and", out, term)
+                left = right
+            return out
+        if isinstance(n, ast.Call) and not n.keywords:
+            if isinstance(n.func, ast.Name):
+                return call(n.func.id, n.args)
+            # close.shift(1) のようなメソッド形式は shift(close, 1) と同じ
+            if isinstance(n.func, ast.Attribute):
+                return call(n.func.attr, [n.func.value] + n.args)
+        raise RuntimeError(f"使えない構文: {ast.unparse(n)} in {expr!r}")
+
+    return conv(tree.body)
+
+
+def _lookback(node: tuple, memo: dict) -> int:
+    # 最終行の値を出すのに必要な過去行数
+    if node in memo:
+        return memo[node]
+    kind = node[0]
+    if kind in ("const", "bool", "field"):
+        lb = 0
+    elif kind.startswith("rolling_"):
+        lb = _lookback(node[1], memo) + node[2] - 1
+    elif kind == "shift":
+        lb = _lookback(node[1], memo) + node[2]
+    else:
+        lb = max(_lookback(c, memo) for c in node[1:] if isinstance(c, tuple))
+    memo[node] = lb
+    return lb
+
+
+@dataclass
+class Plan:
+    """
+    複数戦略をまとめてコンパイルした評価計画。
+    nodes は重複のないトポロジカル順で、evaluate は各ノードを1回だけ計算する。
+    """
+    strategies: list[Strategy]
+    nodes: list[tuple]
+    outputs: Dict[str, Dict[str, tuple]]
+    lookback: int
+
+
+def compile_strategies(strategies: list[Strategy]) -> Plan:
+    outputs: Dict[str, Dict[str, tuple]] = {}
+    for s in strategies:
+        if s.name in outputs:
+            raise RuntimeError(f"戦略名が重複しています: {s.name}")
+        names: dict[str, tuple] = {}
+        cols: Dict[str, tuple] = {}
+        for k, expr in s.indicators.items():
+            names[k] = cols[k] = _parse(expr, names, s.params)
+
+        total: tuple = ("const", 0)
+        for k, expr in s.scores.items():
+            node = _parse(expr, names, s.params)
+            cols[f"{k}_score"] = node
+            total = ("add", total, node)
+        names["score_total"] = cols["score_total"] = total
+        cols["passed"] = _parse(s.passed, names, s.params)
+        outputs[s.name] = cols
+
+    nodes: list[tuple] = []
+    seen: set = set()
+
+    def visit(node: tuple) -> None:
+        if node in seen:
+            return
+        for c in node[1:]:
+            if isinstance(c, tuple):
+                visit(c)
+        seen.add(node)
+        nodes.append(node)
+
+    memo: dict = {}
+    lookback = 0
+    for cols in outputs.values():
+        for node in cols.values():
+            visit(node)
+            lookback = max(lookback, _lookback(node, memo))
+    return Plan(strategies=list(strategies), nodes=nodes, outputs=outputs, lookback=lookback)
+
+
+# --- パネル（行=末尾からの位置, 列=ticker）で一括評価 ---
+
+@dataclass
+class Panel:
+    """
+    各銘柄の末尾 rows 行を右詰めで並べたもの。最終行がその銘柄の最新日（d0）になる。
+    市場ごとに休日が違っても、銘柄ごとの rolling/shift と同じ値になる。
+    """
+    fields: Dict[str, pd.DataFrame]
+    last_date: pd.Series
+    n_rows: pd.Series
+
+
+def load_panel(tickers: list[str], prices_dir: Path, rows: int) -> Panel:
+    cols = {f: {} for f in FIELDS.values()}
+    last_date, n_rows = {}, {}
+    pos = pd.RangeIndex(-rows + 1, 1)
+    for t in tickers:
+        path = prices_dir / f"{t}.parquet"
+        if not path.exists():
+            continue
+        df = pd.read_parquet(path).sort_index()
+        if df.empty:
+            continue
+        tail = df.iloc[-rows:]
+        for f in cols:
+            v = np.full(rows, np.nan)
+            v[rows - len(tail):] = tail[f].to_numpy(dtype=float)
+            cols[f][t] = v
+        last_date[t] = df.index[-1]
+        n_rows[t] = len(df)
+    fields = {f: pd.DataFrame(d, index=pos, columns=list(d.keys())) for f, d in cols.items()}
+    return Panel(fields=fields, last_date=pd.Series(last_date, dtype=object), n_rows=pd.Series(n_rows, dtype=int))
+
+
+def _num(x):
+    # bool列の足し算が論理和にならないよう数値にする
+    if isinstance(x, pd.DataFrame) and x.dtypes.eq(bool).all():
+        return x.astype(int)
+    return x
+
+
+def _bool(x):
+    # NaN は False（比較と同じ扱い）
+    if isinstance(x, pd.DataFrame):
+        return x.fillna(0).astype(bool)
+    return bool(x) and not (isinstance(x, float) and math.isnan(x))
+
+
+def _div(a, b):
+    # 0割りは inf ではなく NaN（screen_one_ticker と同じ扱い）
+    if isinstance(b, pd.DataFrame):
+        return a / b.where(b != 0)
+    return a / b if b != 0 else a * math.nan
+
+
+def _apply(node: tuple, v: list, like: pd.DataFrame):
+    kind = node[0]
+    if kind == "add":
+        return _num(v[0]) + _num(v[1])
+    if kind == "sub":
+        return _num(v[0]) - _num(v[1])
+    if kind == "mul":
+        return _num(v[0]) * _num(v[1])
+    if kind == "div":
+        return _div(_num(v[0]), _num(v[1]))
+    if kind == "lt":
+        return v[0] < v[1]
+    if kind == "le":
+        return v[0] <= v[1]
+    if kind == "gt":
+        return v[0] > v[1]
+    if kind == "ge":
+        return v[0] >= v[1]
+    if kind == "eq":
+        return v[0] == v[1]
+    if kind == "ne":
+        return v[0] != v[1]
+    if kind == "and":
+        return _bool(v[0]) & _bool(v[1])
+    if kind == "or":
+        return _bool(v[0]) | _bool(v[1])
+    if kind == "not":
+        # スカラーに ~ を使うと ~True == -2（真）になるので分ける
+        x = _bool(v[0])
+        return ~x if isinstance(x, pd.DataFrame) else not x
+    if kind == "abs":
+        return abs(_num(v[0]))
+    if kind in ("max", "min"):
+        # NaN は無視（TR の前日終値が無い行など）
+        ufunc = np.fmax if kind == "max" else np.fmin
+        out = _num(v[0])
+        for x in v[1:]:
+            out = ufunc(out, _num(x))
+        return out
+    if kind == "where":
+        cond, a, b = v
+        cond = cond if isinstance(cond, pd.DataFrame) else pd.DataFrame(_bool(cond), index=like.index, columns=like.columns)
+        a = a if isinstance(a, pd.DataFrame) else pd.DataFrame(a, index=like.index, columns=like.columns)
+        return _num(a).where(_bool(cond), _num(b))
+    if kind == "shift":
+        return v[0].shift(node[2])
+    if kind.startswith("rolling_"):
+        r = _num(v[0]).rolling(node[2])
+        return getattr(r, kind[len("rolling_"):])()
+    raise RuntimeError(f"未知のノード: {kind}")
+
+
+def evaluate(plan: Plan, panel: Panel) -> Dict[str, pd.DataFrame]:
+    like = panel.fields["Close"]
+    values: dict[tuple, object] = {}
+    for node in plan.nodes:
+        kind = node[0]
+        if kind in ("const", "bool"):
+            values[node] = node[1]
+        elif kind == "field":
+            values[node] = panel.fields[node[1]]
+        else:
+            args = [values[c] for c in node[1:] if isinstance(c, tuple)]
+            values[node] = _apply(node, args, like)
+
+    out: Dict[str, pd.DataFrame] = {}
+    for s in plan.strategies:
+        # 各銘柄の最新日（=最終行）だけ取り出す
+        res = {}
+        for col, node in plan.outputs[s.name].items():
+            val = values[node]
+            if isinstance(val, pd.DataFrame):
+                res[col] = val.iloc[-1]
+            else:
+                res[col] = pd.Series(val, index=like.columns)
+        df = pd.DataFrame(res, index=like.columns)
+        df["passed"] = df["passed"].astype(bool)
+        for col in df.columns:
+            if (col.endswith("_score") or col == "score_total") and df[col].dtype == bool:
+                df[col] = df[col].astype(int)
+        df = df[panel.n_rows.reindex(df.index) >= s.min_rows]
+        df.insert(0, "ticker", df.index.astype(str))
+        df.insert(0, "date", [str(pd.Timestamp(d).date()) for d in panel.last_date.reindex(df.index)])
+        out[s.name] = df.reset_index(drop=True)
+    return out
+
+
+def run_strategies(
+    univ_us: pd.DataFrame,
+    univ_jp: pd.DataFrame,
+    strategies: list[Strategy],
+    prices_dir: Path = PRICES_DIR,
+    chunk_size: int = 2000,
+    limit: int | None = None,
+    us_ok: bool | None = None,
+    jp_ok: bool | None = None,
+) -> Dict[str, pd.DataFrame]:
+    """
+    全戦略を1回のデータ走査で評価し、run_screen と同じ絞り込み・並べ替えをして返す。
+    us_ok / jp_ok を渡せば地合い判定はそれを使う（呼び出し側と値がずれないように）。
+    """
+    from .screen import market_filter_ok
+
+    plan = compile_strategies(strategies)
+    rows = plan.lookback + 1
+
+    tickers_us = univ_us[univ_us["enabled"] == True]["ticker"].astype(str).tolist()
+    tickers_jp = univ_jp[univ_jp["enabled"] == True]["ticker"].astype(str).tolist()
+    if limit:
+        tickers_us = tickers_us[:limit]
+        tickers_jp = tickers_jp[:limit]
+
+    if us_ok is None:
+        us_ok = market_filter_ok(prices_dir, US_INDEX_TICKER, ma_days=50)
+    if jp_ok is None:
+        jp_ok = market_filter_ok(prices_dir, JP_INDEX_TICKER, ma_days=50)
+
+    parts: Dict[str, list] = {s.name: [] for s in strategies}
+    for market, tickers, ok in [("US", tickers_us, us_ok), ("JP", tickers_jp, jp_ok)]:
+        for i in range(0, len(tickers), chunk_size):
+            panel = load_panel(tickers[i:i+chunk_size], prices_dir, rows)
+            if panel.last_date.empty:
+                continue
+            for name, df in evaluate(plan, panel).items():
+                df["market"] = market
+                df["index_ok"] = ok
+                parts[name].append(df)
+
+    out: Dict[str, pd.DataFrame] = {}
+    for s in strategies:
+        frames = [f for f in parts[s.name] if not f.empty]
+        df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+        if not df.empty:
+            df = df[(df["index_ok"] == True) & (df["passed"] == True)].copy()
+            sort_cols = [c for c in s.sort if c in df.columns]
+            if sort_cols:
+                df = df.sort_values(sort_cols, ascending=False)
+            df = df.reset_index(drop=True)
+        out[s.name] = df
+    return out
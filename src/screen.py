@@ -2,16 +2,22 @@
 
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict
+from typing import TYPE_CHECKING, Dict, Iterator
+import heapq
 import math
 import pandas as pd
 
+from .store import atomic_open
+
 # config の定数名が揺れても動くようにする
 try:
     from .config import PRICES_DIR, US_INDEX_TICKER, JP_INDEX_TICKER
 except Exception:
     from .config import PRICES_DIR, US_INDEX as US_INDEX_TICKER, JP_INDEX_PROXY as JP_INDEX_TICKER
 
+if TYPE_CHECKING:
+    from .screen_cache import ScreenCache
+
 
 @dataclass
 class ScreenParams:
@@ -197,7 +203,12 @@ def screen_one_ticker(ticker: str, p: ScreenParams) -> Dict:
     }
 
 
-def run_screen(univ_us: pd.DataFrame, univ_jp: pd.DataFrame, p: ScreenParams, limit: int | None = None) -> pd.DataFrame:
+# 合計点優先 → RVOL → ギャップ → TR比
+SORT_COLS = ["score_total", "rvol", "gap_pct", "tr_ratio"]
+
+
+def iter_screen_rows(univ_us: pd.DataFrame, univ_jp: pd.DataFrame, p: ScreenParams, limit: int | None = None, cache: ScreenCache | None = None) -> Iterator[Dict]:
+    """全銘柄の診断行（market / index_ok 付き）を1件ずつ返す。絞り込みはしない。"""
     tickers_us = univ_us[univ_us["enabled"] == True]["ticker"].astype(str).tolist()
     tickers_jp = univ_jp[univ_jp["enabled"] == True]["ticker"].astype(str).tolist()
 
@@ -208,20 +219,42 @@ def run_screen(univ_us: pd.DataFrame, univ_jp: pd.DataFrame, p: ScreenParams, li
     us_ok = market_filter_ok(PRICES_DIR, US_INDEX_TICKER, ma_days=50)
     jp_ok = market_filter_ok(PRICES_DIR, JP_INDEX_TICKER, ma_days=50)
 
-    rows = []
+    key = None
+    if cache is not None:
+        from .screen_cache import params_key
+        key = params_key(p)
+
+    def screen_cached(t: str) -> Dict:
+        if cache is None:
+            return screen_one_ticker(t, p)
+        # データ指紋が同じなら前回の結果をそのまま使う
+        fp = cache.fingerprint(t)
+        r = cache.get(key, t, fp)
+        if r is None:
+            r = screen_one_ticker(t, p)
+            cache.put(key, t, fp, r)
+        return r
+
     for t in tickers_us:
-        r = screen_one_ticker(t, p)
+        r = screen_cached(t)
         if r:
             r["market"] = "US"
             r["index_ok"] = us_ok
-            rows.append(r)
+            yield r
 
     for t in tickers_jp:
-        r = screen_one_ticker(t, p)
+        r = screen_cached(t)
         if r:
             r["market"] = "JP"
             r["index_ok"] = jp_ok
-            rows.append(r)
+            yield r
+
+    if cache is not None:
+        cache.save()
+
+
+def run_screen(univ_us: pd.DataFrame, univ_jp: pd.DataFrame, p: ScreenParams, limit: int | None = None, cache: ScreenCache | None = None) -> pd.DataFrame:
+    rows = list(iter_screen_rows(univ_us, univ_jp, p, limit=limit, cache=cache))
 
     out = pd.DataFrame(rows)
     if out.empty:
@@ -230,8 +263,66 @@ def run_screen(univ_us: pd.DataFrame, univ_jp: pd.DataFrame, p: ScreenParams, li
     out = out[out["index_ok"] == True].copy()
     out = out[out["passed"] == True].copy()
 
-    # 合計点優先 → RVOL → ギャップ → TR比
-    sort_cols = ["score_total", "rvol", "gap_pct", "tr_ratio"]
-    sort_cols = [c for c in sort_cols if c in out.columns]
+    sort_cols = [c for c in SORT_COLS if c in out.columns]
     out = out.sort_values(sort_cols, ascending=False).reset_index(drop=True)
     return out
+
+
+def _sort_key(r: Dict) -> tuple:
+    # sort_values(ascending=False) と同じく NaN は最後
+    key = []
+    for c in SORT_COLS:
+        v = r.get(c, math.nan)
+        key.append(-math.inf if v is None or pd.isna(v) else float(v))
+    return tuple(key)
+
+
+def run_screen_streaming(
+    univ_us: pd.DataFrame,
+    univ_jp: pd.DataFrame,
+    p: ScreenParams,
+    diag_path: Path,
+    top_k: int = 200,
+    chunk_size: int = 500,
+    limit: int | None = None,
+    cache: ScreenCache | None = None,
+) -> pd.DataFrame:
+    """
+    run_screen のメモリ一定版。
+    通過銘柄は上位 top_k だけヒープに残し、全銘柄の診断行は chunk_size ごとに diag_path へ追記する。
+    上位 top_k の並びは run_screen の先頭 top_k と同じ。
+    """
+    if top_k < 1 or chunk_size < 1:
+        raise ValueError(f"top_k / chunk_size は1以上: top_k={top_k}, chunk_size={chunk_size}")
+
+    heap: list[tuple] = []
+    chunk: list[Dict] = []
+    columns: list[str] | None = None
+
+    with atomic_open(diag_path) as f:
+
+        def flush() -> None:
+            nonlocal columns
+            if not chunk:
+                return
+            if columns is None:
+                columns = list(chunk[0].keys())
+            pd.DataFrame(chunk, columns=columns).to_csv(f, index=False, header=f.tell() == 0)
+            chunk.clear()
+
+        for seq, r in enumerate(iter_screen_rows(univ_us, univ_jp, p, limit=limit, cache=cache)):
+            chunk.append(r)
+            if len(chunk) >= chunk_size:
+                flush()
+            if not (r["index_ok"] and r["passed"]):
+                continue
+            # 同点は先に出た銘柄を残す（安定ソートと同じ）
+            item = (_sort_key(r), -seq, r)
+            if len(heap) < top_k:
+                heapq.heappush(heap, item)
+            elif item[:2] > heap[0][:2]:
+                heapq.heapreplace(heap, item)
+        flush()
+
+    rows = [item[2] for item in sorted(heap, key=lambda x: x[:2], reverse=True)]
+    return pd.DataFrame(rows, columns=columns) if rows else pd.DataFrame(columns=columns or [])
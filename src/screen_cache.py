@@ -0,0 +1,116 @@
+﻿from __future__ import annotations
+from collections import OrderedDict
+from dataclasses import asdict
+from pathlib import Path
+import hashlib
+import json
+from .store import PriceManifest, atomic_write_text
+
+CACHE_FORMAT = 1
+MAX_VARIANTS = 8
+
+
+def code_version() -> str:
+    # screen.py が変われば結果も変わりうるので、ソースのハッシュをキーに含める
+    src = Path(__file__).with_name("screen.py").read_bytes()
+    return hashlib.sha256(src).hexdigest()[:16]
+
+
+def params_key(p) -> str:
+    payload = json.dumps({"params": asdict(p), "code": code_version()}, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+class ScreenCache:
+    """
+    screen_one_ticker の結果キャッシュ。
+    キー: ScreenParams+コード版 → ticker → データ指紋（manifestのchecksum/最終日）。
+    データが変わった銘柄だけ再計算し、パラメータ違いは LRU で max_variants 個まで持つ。
+    """
+
+    def __init__(self, path: Path, manifest: PriceManifest, max_variants: int = MAX_VARIANTS):
+        self.path = path
+        self.manifest = manifest
+        self.max_variants = max_variants
+        self.variants: OrderedDict[str, dict] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # 今回の実行で指紋が取れた銘柄（save 時にそれ以外を捨てる）
+        self.seen: dict[str, set[str]] = {}
+        self._dirty = False
+
+    @classmethod
+    def load(cls, path: Path, prices_dir: Path, max_variants: int = MAX_VARIANTS) -> "ScreenCache":
+        cache = cls(path, PriceManifest.load(prices_dir), max_variants=max_variants)
+        if path.exists():
+            try:
+                raw = json.loads(path.read_text(encoding="utf-8"))
+                if raw.get("format") == CACHE_FORMAT:
+                    # 保存順＝古い順
+                    for k, v in raw.get("variants", []):
+                        cache.variants[k] = v
+            except (ValueError, OSError):
+                cache.variants.clear()
+        return cache
+
+    def fingerprint(self, ticker: str) -> str | None:
+        e = self.manifest.get(ticker)
+        if e is None:
+            # manifest未登録/古いときはファイルから作り直す（次回以降は読まない）
+            try:
+                e = self.manifest.refresh(ticker)
+            except Exception:
+                return None
+        if e is None:
+            return None
+        return f"{e['last_date']}:{e['checksum']}"
+
+    def variant(self, key: str) -> dict:
+        v = self.variants.get(key)
+        if v is None:
+            v = {}
+            self.variants[key] = v
+            self._dirty = True
+        elif next(reversed(self.variants)) != key:
+            self._dirty = True
+        self.variants.move_to_end(key)
+        return v
+
+    def get(self, key: str, ticker: str, fp: str | None) -> dict | None:
+        if fp is None:
+            return None
+        self.seen.setdefault(key, set()).add(ticker)
+        hit = self.variant(key).get(ticker)
+        if hit is None or hit["fp"] != fp:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return dict(hit["row"])
+
+    def put(self, key: str, ticker: str, fp: str | None, row: dict) -> None:
+        if fp is None:
+            return
+        self.variant(key)[ticker] = {"fp": fp, "row": dict(row)}
+        self._dirty = True
+
+    def save(self) -> None:
+        # ユニバースから外れた・除外/削除された銘柄は今回使ったバリアントから落とす
+        for key, seen in self.seen.items():
+            v = self.variants.get(key)
+            if v is None:
+                continue
+            stale = [t for t in v if t not in seen]
+            for t in stale:
+                del v[t]
+            if stale:
+                self._dirty = True
+        while len(self.variants) > self.max_variants:
+            self.variants.popitem(last=False)
+            self._dirty = True
+        # refresh で増えた manifest エントリも残しておく
+        self.manifest.save()
+        if not self._dirty:
+            return
+        payload = {"format": CACHE_FORMAT, "variants": list(self.variants.items())}
+        atomic_write_text(self.path, json.dumps(payload, ensure_ascii=False))
+        self._dirty = False
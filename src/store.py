@@ -0,0 +1,184 @@
+﻿from __future__ import annotations
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, TextIO
+from datetime import datetime, timezone
+import hashlib
+import io
+import json
+import os
+import tempfile
+import pandas as pd
+
+# 価格parquetのレイアウトが変わったら上げる（manifestのエントリを無効化するため）
+SCHEMA_VERSION = 1
+MANIFEST_NAME = "_manifest.json"
+TMP_SUFFIX = ".tmp"
+
+
+def atomic_write_bytes(path: Path, data: bytes) -> None:
+    """
+    同じディレクトリの一時ファイルに書いて fsync → os.replace で差し替える。
+    途中で落ちても元ファイルは壊れず、残るのは *.tmp だけ。
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=TMP_SUFFIX)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+@contextmanager
+def atomic_open(path: Path, encoding: str = "utf-8") -> Iterator[TextIO]:
+    """
+    少しずつ書き足す出力用。with を抜けたときだけ path に差し替わる。
+    例外で抜けたら一時ファイルを消し、元のファイルはそのまま。
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.", suffix=TMP_SUFFIX)
+    try:
+        with os.fdopen(fd, "w", encoding=encoding, newline="") as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def atomic_write_text(path: Path, text: str, encoding: str = "utf-8") -> None:
+    atomic_write_bytes(path, text.encode(encoding))
+
+
+def atomic_write_csv(path: Path, df: pd.DataFrame, **kwargs) -> None:
+    kwargs.setdefault("index", False)
+    atomic_write_text(path, df.to_csv(**kwargs))
+
+
+def atomic_write_parquet(path: Path, df: pd.DataFrame) -> str:
+    """parquetをアトミックに書き、書いたバイト列のsha256を返す。"""
+    buf = io.BytesIO()
+    df.to_parquet(buf)
+    data = buf.getvalue()
+    atomic_write_bytes(path, data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def cleanup_tmp_files(directory: Path) -> list[Path]:
+    # 書き込み途中で落ちた残骸（.*.tmp）を掃除する
+    removed = []
+    if not directory.exists():
+        return removed
+    for p in directory.glob(f".*{TMP_SUFFIX}"):
+        try:
+            p.unlink()
+            removed.append(p)
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+class PriceManifest:
+    """
+    価格ストアのメタデータ索引（ticker → 行数・期間・checksum・schema）。
+    audit / fetch計画はここだけ見ればよく、データファイルを開かずに済む。
+    save() はアトミックに書くので、manifest自体が壊れることはない。
+    """
+
+    def __init__(self, path: Path, entries: dict[str, dict] | None = None):
+        self.path = path
+        self.entries: dict[str, dict] = entries or {}
+        self._dirty = False
+
+    @classmethod
+    def load(cls, prices_dir: Path) -> "PriceManifest":
+        path = prices_dir / MANIFEST_NAME
+        entries: dict[str, dict] = {}
+        if path.exists():
+            try:
+                raw = json.loads(path.read_text(encoding="utf-8"))
+                entries = raw.get("tickers", {})
+            except (ValueError, OSError):
+                # 読めなければ空から作り直す（データファイルは無事）
+                entries = {}
+        return cls(path, entries)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, ticker: str) -> bool:
+        return ticker in self.entries
+
+    def get(self, ticker: str) -> dict | None:
+        """
+        ファイルの size/mtime が記録と一致するときだけエントリを返す。
+        データ書き込み後・manifest保存前に落ちた場合などは None（=ファイルを読み直す）。
+        """
+        e = self.entries.get(ticker)
+        if e is None or e.get("schema_version") != SCHEMA_VERSION:
+            return None
+        p = self.path.parent / f"{ticker}.parquet"
+        try:
+            st = p.stat()
+        except FileNotFoundError:
+            return None
+        if st.st_size != e.get("size") or st.st_mtime_ns != e.get("mtime_ns"):
+            return None
+        return e
+
+    def record(self, ticker: str, df: pd.DataFrame, checksum: str) -> dict:
+        p = self.path.parent / f"{ticker}.parquet"
+        st = p.stat()
+        idx = df.index
+        e = {
+            "rows": int(len(df)),
+            "rows_valid": int(len(df.dropna())),
+            "columns": [str(c) for c in df.columns],
+            "first_date": str(pd.Timestamp(idx.min()).date()) if len(idx) else None,
+            "last_date": str(pd.Timestamp(idx.max()).date()) if len(idx) else None,
+            "checksum": checksum,
+            "schema_version": SCHEMA_VERSION,
+            "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns,
+        }
+        self.entries[ticker] = e
+        self._dirty = True
+        return e
+
+    def refresh(self, ticker: str) -> dict | None:
+        # 既存ファイルから読み直してエントリを作る（manifest導入前のファイル用）
+        p = self.path.parent / f"{ticker}.parquet"
+        if not p.exists():
+            self.drop(ticker)
+            return None
+        data = p.read_bytes()
+        df = pd.read_parquet(io.BytesIO(data))
+        return self.record(ticker, df, hashlib.sha256(data).hexdigest())
+
+    def drop(self, ticker: str) -> None:
+        if self.entries.pop(ticker, None) is not None:
+            self._dirty = True
+
+    def save(self) -> None:
+        if not self._dirty and self.path.exists():
+            return
+        payload = {
+            "schema_version": SCHEMA_VERSION,
+            "updated_utc": datetime.now(timezone.utc).isoformat(),
+            "tickers": dict(sorted(self.entries.items())),
+        }
+        atomic_write_text(self.path, json.dumps(payload, ensure_ascii=False))
+        self._dirty = False
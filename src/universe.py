@@ -2,7 +2,7 @@
 import io
 from pathlib import Path
 import pandas as pd
-import requests
+from .store import atomic_write_csv
 
 DATAHUB_SP500_CSV = "https://datahub.io/core/s-and-p-500-companies/r/constituents.csv"
 RAW_GITHUB_SP500_CSV = "https://raw.githubusercontent.com/datasets/s-and-p-500-companies/master/data/constituents.csv"
@@ -11,6 +11,8 @@ JPX_TOPIX_WEIGHT_URL = "https://www.jpx.co.jp/automation/markets/indices/topix/f
 UA = "Mozilla/5.0 (compatible; trend-catalyst-screener/1.0)"
 
 def build_universe_us_sp500(save_path: Path) -> pd.DataFrame:
+    import requests
+
     urls = [DATAHUB_SP500_CSV, RAW_GITHUB_SP500_CSV]
     last_err = None
 
@@ -31,7 +33,7 @@ def build_universe_us_sp500(save_path: Path) -> pd.DataFrame:
             }).drop_duplicates(subset=["ticker"])
 
             out["ticker"] = out["ticker"].str.replace(".", "-", regex=False)
-            out.to_csv(save_path, index=False, encoding="utf-8")
+            atomic_write_csv(save_path, out)
             return out
         except Exception as e:
             last_err = e
@@ -39,6 +41,8 @@ def build_universe_us_sp500(save_path: Path) -> pd.DataFrame:
     raise RuntimeError(f"S&P500取得失敗: {last_err}")
 
 def build_universe_jp_topix_newindex(save_path: Path) -> pd.DataFrame:
+    import requests
+
     r = requests.get(JPX_TOPIX_WEIGHT_URL, headers={"User-Agent": UA}, timeout=30)
     r.raise_for_status()
 
@@ -83,5 +87,5 @@ def build_universe_jp_topix_newindex(save_path: Path) -> pd.DataFrame:
         "note": ""
     }).drop_duplicates(subset=["ticker"])
 
-    out.to_csv(save_path, index=False, encoding="utf-8")
+    atomic_write_csv(save_path, out)
     return out